@@ -1,17 +1,26 @@
 import atexit
+import os
 import signal
-import time
-from flask import Flask, request, send_from_directory
+import threading
+from flask import Flask, request, send_from_directory, make_response, abort
+from werkzeug.http import generate_etag
+from werkzeug.security import safe_join
 from flask_cors import CORS
 from stream_controller import sc
 from storage import sm
-from config import HLS_OUTPUT_DIR, WATER_MARK_PATH
-from utils.app_utils import error, success
-from threading import Thread
+from task_queue import tq
+from config import HLS_OUTPUT_DIR, WATER_MARK_PATH, HLS_ACCEL_REDIRECT
+from utils.app_utils import error, success, not_modified, save_upload, OrjsonProvider
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
+HLS_MIMETYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".ts": "video/mp2t",
+}
+
 
 # -------- 健康接口 --------
 @app.route('/api/welcome', methods=['GET'])
@@ -77,8 +86,9 @@ def update_url():
     """
     更新指定流的url
     """
-    stream_uid = request.json.get("stream_uid")
-    url = request.json.get("url")
+    payload = request.get_json(silent=True) or {}
+    stream_uid = payload.get("stream_uid")
+    url = payload.get("url")
     # 更新绑定信息
     sm.update_url(
         uid=stream_uid,
@@ -103,7 +113,7 @@ def update_water_mark():
     save_path = None
     if file:
         save_path = f"{WATER_MARK_PATH}/{stream_uid}.png"
-        file.save(save_path)
+        save_upload(file, save_path)
     # 更新绑定信息
     sm.update_watermark(
         uid=stream_uid,
@@ -131,7 +141,7 @@ def update_fence_water_mark():
         return error("参数缺失", 400)
 
     save_path = f"{WATER_MARK_PATH}/{stream_uid}_{fence_uid}.png"
-    file.save(save_path)
+    save_upload(file, save_path)
 
     sm.update_watermark_by_wm_uid(
         uid=stream_uid,
@@ -149,37 +159,66 @@ def update_fence_water_mark():
 # ----------------------
 # 清空水印
 # ----------------------
+def clear_water_mark_task(stream_uid):
+    """后台任务：停止转流并等待 ffmpeg 释放水印文件，清空水印后再重新启动"""
+    info = sm.get_info(stream_uid)
+    if info is None:  # 任务执行前绑定可能已被删除
+        raise ValueError(f"未找到对应的流: {stream_uid}")
+    running = info["status"] == "started"
+    if running:
+        # 先标记 stopping，避免管理线程把进程退出当作异常
+        sm.update_status(stream_uid, "stopping")
+        sc.stop_stream_sync(stream_uid)
+    if not sm.clear_watermarks(stream_uid):
+        raise ValueError(f"未找到对应的流: {stream_uid}")
+    if running:
+        # 已在此处安排重启，刷新监控缓存避免水印变化再触发一次重启
+        sc.refresh_cache(stream_uid)
+        sm.update_status(stream_uid, "need_start")
+    return {"stream_uid": stream_uid}
+
+
 @app.route('/api/water_mark', methods=['DELETE'])
 def delete_water_mark():
     try:
-        data = request.json
+        data = request.get_json(silent=True) or {}
         stream_uid = data.get("stream_uid")
 
         if not stream_uid:
             return error("缺少参数 stream_uid")
-
-        # 调用 storage 清空水印
-        # sm.update_status(stream_uid, "stopped")
-        # sc.stop_stream(stream_uid)
-        time.sleep(1)
-        if sm.clear_watermarks(stream_uid):
-            # sm.update_status(stream_uid, "running")
-            # sc.start_stream(stream_uid)
-            return success("水印已清空", {"stream_uid": stream_uid})
-        else:
+        if sm.get_info(stream_uid) is None:
             return error("未找到对应的流")
 
+        # 清空水印放到后台执行，接口立即返回任务 ID
+        task_id = tq.submit("clear_water_mark", clear_water_mark_task, stream_uid)
+        return success("水印清空中", {"stream_uid": stream_uid, "task_id": task_id}, code=202)
+
     except Exception as e:
         return error(f"删除水印失败: {str(e)}")
 
 
+# ----------------------
+# 查询后台任务状态
+# ----------------------
+@app.route("/api/task/<task_id>", methods=["GET"])
+def get_task(task_id):
+    task = tq.get_task(task_id)
+    if task is None:
+        return error("未找到对应的任务", 404)
+    return success("任务状态获取成功", task)
+
+
 # ----------------------
 # 查询所有绑定信息
 # ----------------------
 @app.route("/api/list", methods=["GET"])
 def list_bindings():
+    # 先取版本再取数据：期间有修改时返回的是较新数据配旧 ETag，下次请求会重新获取
+    etag = f"{sm.epoch}-{sm.version}"
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
     data = sm.list_bindings()
-    return success("绑定列表获取成功", data)
+    return success("绑定列表获取成功", data, etag=etag)
 
 
 # ----------------------
@@ -188,7 +227,11 @@ def list_bindings():
 @app.route("/api/running", methods=["GET"])
 def list_running():
     data = sc.list_running()
-    return success("正在转流列表获取成功", data)
+    # 与响应使用同一个 JSON 序列化（orjson，按键排序），内容相同时 ETag 不变
+    etag = generate_etag(app.json.dumps(data).encode())
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+    return success("正在转流列表获取成功", data, etag=etag)
 
 
 # ----------------------
@@ -196,34 +239,55 @@ def list_running():
 # ----------------------
 @app.route("/hls/<path:filename>")
 def serve_hls(filename):
+    if HLS_ACCEL_REDIRECT:
+        if safe_join(HLS_OUTPUT_DIR, filename) is None:
+            abort(404)
+        # 交给 nginx 用 sendfile 直接发送文件，不经过 Python 拷贝
+        response = make_response("")
+        response.headers["X-Accel-Redirect"] = f"{HLS_ACCEL_REDIRECT.rstrip('/')}/{filename}"
+        response.headers["Content-Type"] = HLS_MIMETYPES.get(
+            os.path.splitext(filename)[1], "application/octet-stream"
+        )
+        return response
     return send_from_directory(HLS_OUTPUT_DIR, filename)
 
 
 # ---------------------- 启动监控线程 ----------------------
-monitor_thread = Thread(target=sc.monitor_watermarks, daemon=True)
-monitor_thread.start()
+sc.start_monitor()
 
 
 # ---------------------- 注册退出钩子 ----------------------
+_cleanup_lock = threading.Lock()
+_cleaned = False
+
+
 def cleanup():
-    sm.update_all_status("stopped")  # 调用 stop_all 停止所有流和 ffmpeg
+    # 信号处理后 exit(0) 还会触发 atexit，保证只执行一次
+    global _cleaned
+    with _cleanup_lock:
+        if _cleaned:
+            return
+        _cleaned = True
+    # ffmpeg 在独立会话中运行，不会随服务一起收到信号，必须在这里逐个结束
+    sc.stop_all()
+    sm.update_all_status("stopped")
 
 
 # 当 Python 解释器正常退出时调用
 atexit.register(cleanup)
 
 
-# 捕获 SIGINT 和 SIGTERM 让 stop_all 也在 ctrl+c 或 kill 时生效
+# 捕获 SIGINT 和 SIGTERM 让 cleanup 也在 ctrl+c 或 kill 时生效
+# 只在直接运行时注册：gunicorn 下由 worker 自己处理信号，清理在 gunicorn.conf.py 的 worker_exit 中执行
 def handle_signal(sig, frame):
     cleanup()
     exit(0)
 
 
-signal.signal(signal.SIGINT, handle_signal)  # Ctrl+C
-signal.signal(signal.SIGTERM, handle_signal)  # kill 命令
-
 # ----------------------
-# 启动 Flask
+# 启动 Flask（开发/Windows 环境；Linux 生产环境使用 gunicorn -c gunicorn.conf.py wsgi:app）
 # ----------------------
 if __name__ == "__main__":
+    signal.signal(signal.SIGINT, handle_signal)  # Ctrl+C
+    signal.signal(signal.SIGTERM, handle_signal)  # kill 命令
     app.run(host="0.0.0.0", port=5001)
@@ -4,6 +4,23 @@ FLOW_URL = "http://1.94.137.200:5001"  # 华为云转流服务
 # FLOW_URL = "http://10.30.3.178:5001"  # 公司转流服务
 
 DATA_FILE = "data"
-STORAGE_JSON_FILE = "data/stream_map.json"
+STORAGE_DB_FILE = "data/stream_map.db"
+STORAGE_JSON_FILE = "data/stream_map.json"  # 旧版存储文件，启动时自动迁移到数据库
 HLS_OUTPUT_DIR = "hls"
-WATER_MARK_PATH = 'watermarks'
\ No newline at end of file
+WATER_MARK_PATH = 'watermarks'
+DEVICE_CACHE_FILE = "data/device_cache.json"  # 设备检测结果缓存
+
+# 设为 True 时，使用 GPU 的情况下解码、叠加水印、编码全程在显存中进行（需要 ffmpeg 带 overlay_cuda 滤镜，缺少时自动回退）；
+# 只有确认视频源都能用 NVDEC 解码时才开启，否则带水印的输出会失败
+FFMPEG_CUDA_PIPELINE = False
+
+# 前置 nginx 时填写 internal location 前缀（如 "/hls-internal/"），
+# HLS 文件由 nginx 通过 X-Accel-Redirect 直接 sendfile 发送；为 None 时由 Flask 发送
+HLS_ACCEL_REDIRECT = None
+
+# 同时运行的 ffmpeg 进程上限，超出的启动请求排队等待空位；None 表示不限制
+MAX_CONCURRENT_STREAMS = None
+
+# 视频源已是 H.264 时可设为 True：无水印输出直接复制视频流（-c:v copy），不再解码重编码；
+# 输出保持源的帧率和关键帧间隔（HLS 分片按源关键帧切分）
+HLS_COPY_NO_WM = False
@@ -0,0 +1,24 @@
+# gunicorn 配置：gunicorn -c gunicorn.conf.py wsgi:app
+
+bind = "0.0.0.0:5001"
+
+# ffmpeg 进程和监控线程由进程内的 StreamController 管理，
+# 多个 worker 会各自拉起一套 ffmpeg，因此固定单 worker，用线程提升并发
+workers = 1
+worker_class = "gthread"
+threads = 16
+
+# 不预加载：应用在 worker 中导入，后台线程只在 worker 里启动一次
+preload_app = False
+
+# HLS 播放器每隔几秒拉一次分片，保持长连接避免每次重新握手（sync worker 不支持）
+keepalive = 75
+
+timeout = 60
+graceful_timeout = 10
+
+
+def worker_exit(server, worker):
+    """worker 退出（正常关闭或重载）时结束其拉起的所有 ffmpeg，并把流状态置为 stopped"""
+    from app import cleanup
+    cleanup()
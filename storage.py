@@ -1,71 +1,268 @@
 import os
 import json
+import time
 import uuid
+import atexit
 import shutil
-from config import STORAGE_JSON_FILE, HLS_OUTPUT_DIR, DATA_FILE, WATER_MARK_PATH
+import sqlite3
+import operator
+import functools
+import threading
+import contextlib
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时退回标准库 json
+    orjson = None
+from config import STORAGE_DB_FILE, STORAGE_JSON_FILE, HLS_OUTPUT_DIR, DATA_FILE, WATER_MARK_PATH
 
-# 如果目录存在就先删除
-if os.path.exists(HLS_OUTPUT_DIR):
-    shutil.rmtree(HLS_OUTPUT_DIR)
+# 目录初始化标记，保证每个进程只初始化一次
+_dirs_ready = False
 
-os.makedirs(DATA_FILE, exist_ok=True)
-os.makedirs(HLS_OUTPUT_DIR, exist_ok=True)
-os.makedirs(WATER_MARK_PATH, exist_ok=True)
+
+@functools.lru_cache(maxsize=None)
+def _ensure_dir(path):
+    """创建目录，同一路径在进程内只创建一次"""
+    os.makedirs(path, exist_ok=True)
+
+
+def _init_dirs():
+    """清空 HLS 输出目录并创建运行所需目录，每个进程只执行一次"""
+    global _dirs_ready
+    if _dirs_ready:
+        return
+    # 如果目录存在就先删除
+    try:
+        shutil.rmtree(HLS_OUTPUT_DIR)
+    except FileNotFoundError:
+        pass
+    for path in (DATA_FILE, HLS_OUTPUT_DIR, WATER_MARK_PATH):
+        _ensure_dir(path)
+    _dirs_ready = True
+
+
+_init_dirs()
+
+# 未绑定 uid 的锁：数据不存在，无需互斥
+_NO_LOCK = contextlib.nullcontext()
+
+# 写盘合并窗口（秒），窗口内的多次修改只落盘一次
+FLUSH_INTERVAL = 0.1
+
+# 最多保留的删除记录数，超出时丢弃最早的；增量查询的版本早于被丢弃的记录时改为全量同步
+MAX_TOMBSTONES = 1024
+
+
+def _json_dumps(obj):
+    return orjson.dumps(obj).decode() if orjson else json.dumps(obj)
+
+
+def _json_loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+# 绑定表字段，顺序与 _save 中的参数一致
+_COLUMNS = ("uid", "url", "water_mark", "hls_no_wm", "hls_wm", "status")
 
 
 class StorageManager:
     """
     管理视频流 UID、URL、多水印及 HLS 输出路径
-    每次操作都会 load JSON 文件，保证数据最新
+    数据常驻内存，读操作直接查内存，写操作修改内存后记录变更的 UID，
+    由后台线程合并后按行写回 SQLite（WAL 模式）
     """
 
-    def __init__(self, storage_file=STORAGE_JSON_FILE, hls_output_dir=HLS_OUTPUT_DIR):
+    def __init__(self, storage_file=STORAGE_DB_FILE, hls_output_dir=HLS_OUTPUT_DIR,
+                 legacy_json_file=STORAGE_JSON_FILE):
         self.storage_file = storage_file
         self.hls_output_dir = hls_output_dir
-        self._ensure_file()
-
-        if not os.path.exists(hls_output_dir):
-            os.makedirs(hls_output_dir)
+        self.legacy_json_file = legacy_json_file
+        self._lock = threading.RLock()  # 保护绑定的增删与整体遍历
+        self._dirty_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._dirty_uids = set()
+        self._removed_uids = set()
+        # 数据版本：每次修改加一；epoch 区分不同进程，避免重启后版本号重复
+        self.version = 0
+        self.epoch = uuid.uuid4().hex[:8]
+        self._changed_at = {}  # uid -> 最后一次修改时的版本
+        self._removed_at = {}  # uid -> 删除时的版本，按版本从旧到新排列
+        self._tombstone_floor = 0  # 已丢弃的删除记录中最新的版本
+        self._listeners = []  # 数据变化时调用的回调
+        self._conn = self._connect()
+        self._migrate_json()
+        self._data = self._load()
+        # uid -> Lock，单个流的修改互不阻塞；只为已绑定的 uid 创建，解绑时删除
+        self._uid_locks = {uid: threading.Lock() for uid in self._data}
+
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        atexit.register(self.flush)
+
+        _ensure_dir(hls_output_dir)
         self.stop_all_streams()
 
     # ----------------------
     # 将所有流状态设为 stopped
     # ----------------------
     def stop_all_streams(self):
-        data = self._load()
-        updated = False
-        for uid, info in data.items():
-            if info.get("status") != "stopped":
-                info["status"] = "stopped"
-                updated = True
-        if updated:
-            self._save(data)
+        self.update_all_status("stopped")
 
     # ----------------------
-    # 确保 JSON 文件存在
+    # 获取单个流的锁（加锁顺序：先全局锁，后 UID 锁）
     # ----------------------
-    def _ensure_file(self):
-        if not os.path.exists(self.storage_file):
-            os.makedirs(os.path.dirname(self.storage_file), exist_ok=True)
-            with open(self.storage_file, "w") as f:
-                json.dump({}, f)
+    def _uid_lock(self, uid):
+        """未绑定的 uid 返回空上下文，查询不存在的 uid 不会创建锁"""
+        with self._lock:
+            return self._uid_locks.get(uid) or _NO_LOCK
+
+    # ----------------------
+    # 打开数据库并建表
+    # ----------------------
+    def _connect(self):
+        db_dir = os.path.dirname(self.storage_file)
+        if db_dir:
+            _ensure_dir(db_dir)
+        # 连接只在持有 _flush_lock 时使用，可跨线程共享
+        conn = sqlite3.connect(self.storage_file, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS bindings ("
+            "uid TEXT PRIMARY KEY, url TEXT, water_mark TEXT NOT NULL DEFAULT '{}', "
+            "hls_no_wm TEXT, hls_wm TEXT, status TEXT)"
+        )
+        return conn
+
+    # ----------------------
+    # 旧版 JSON 文件迁移到数据库（仅数据库为空时执行一次）
+    # ----------------------
+    def _migrate_json(self):
+        if not self.legacy_json_file or not os.path.exists(self.legacy_json_file):
+            return
+        if self._conn.execute("SELECT 1 FROM bindings LIMIT 1").fetchone():
+            return
+        with open(self.legacy_json_file, "rb") as f:
+            try:
+                data = _json_loads(f.read())
+            except json.JSONDecodeError:  # orjson.JSONDecodeError 也是它的子类
+                data = {}
+        for uid, info in data.items():
+            info.setdefault("water_mark", {})
+        self._save(data)
+        os.replace(self.legacy_json_file, f"{self.legacy_json_file}.bak")
 
     # ----------------------
     # 加载
     # ----------------------
     def _load(self):
-        with open(self.storage_file, "r") as f:
+        rows = self._conn.execute(f"SELECT {', '.join(_COLUMNS)} FROM bindings").fetchall()
+        data = {}
+        for uid, url, water_mark, hls_no_wm, hls_wm, status in rows:
+            data[uid] = {
+                "url": url,
+                "water_mark": _json_loads(water_mark) if water_mark else {},
+                "hls_no_wm": hls_no_wm,
+                "hls_wm": hls_wm,
+                "status": status
+            }
+        return data
+
+    # ----------------------
+    # 保存：upsert 变更的行、删除已移除的行，一个事务内完成
+    # ----------------------
+    def _save(self, data, removed=()):
+        rows = [
+            (uid, info.get("url"), _json_dumps(info.get("water_mark") or {}),
+             info.get("hls_no_wm"), info.get("hls_wm"), info.get("status"))
+            for uid, info in data.items()
+        ]
+        with self._conn:
+            self._conn.execute("BEGIN")
+            if removed:
+                self._conn.executemany("DELETE FROM bindings WHERE uid = ?", [(uid,) for uid in removed])
+            if rows:
+                self._conn.executemany(
+                    f"INSERT OR REPLACE INTO bindings ({', '.join(_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(_COLUMNS))})",
+                    rows
+                )
+
+    # ----------------------
+    # 记录 UID 已修改/删除，等待后台线程落盘
+    # ----------------------
+    def _mark_dirty(self, uid):
+        with self._dirty_lock:
+            self._removed_uids.discard(uid)
+            self._dirty_uids.add(uid)
+            self.version += 1
+            self._changed_at[uid] = self.version
+            self._removed_at.pop(uid, None)
+            self._dirty.set()
+        self._notify()
+
+    def _mark_removed(self, uid):
+        with self._dirty_lock:
+            self._dirty_uids.discard(uid)
+            self._removed_uids.add(uid)
+            self.version += 1
+            self._changed_at.pop(uid, None)
+            self._removed_at.pop(uid, None)  # 重新插入到末尾，保持按版本排序
+            self._removed_at[uid] = self.version
+            if len(self._removed_at) > MAX_TOMBSTONES:
+                oldest = next(iter(self._removed_at))
+                self._tombstone_floor = self._removed_at.pop(oldest)
+            self._dirty.set()
+        self._notify()
+
+    # ----------------------
+    # 变化通知：让后台线程在数据变化时立即处理，而不是等下一次轮询
+    # ----------------------
+    def add_listener(self, callback):
+        """注册数据变化回调（无参数），回调应当足够轻量，如 threading.Event.set"""
+        self._listeners.append(callback)
+
+    def _notify(self):
+        for callback in self._listeners:
+            callback()
+
+    # ----------------------
+    # 立即落盘（没有未保存的修改时直接返回）
+    # ----------------------
+    def flush(self):
+        with self._flush_lock:
+            with self._lock, self._dirty_lock:
+                if not self._dirty.is_set():
+                    return
+                self._dirty.clear()
+                data = {uid: dict(self._data[uid]) for uid in self._dirty_uids if uid in self._data}
+                removed = set(self._removed_uids)
+                self._dirty_uids.clear()
+                self._removed_uids.clear()
             try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                return {}
+                self._save(data, removed)
+            except Exception:
+                # 写入失败时把变更放回去，下一轮重试
+                with self._dirty_lock:
+                    for uid in data:
+                        if uid not in self._removed_uids:
+                            self._dirty_uids.add(uid)
+                    for uid in removed:
+                        if uid not in self._dirty_uids:
+                            self._removed_uids.add(uid)
+                raise
 
     # ----------------------
-    # 保存
+    # 后台落盘线程
     # ----------------------
-    def _save(self, data):
-        with open(self.storage_file, "w") as f:
-            json.dump(data, f, indent=2)
+    def _flush_loop(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[WARN] 保存绑定数据失败: {self.storage_file}, 错误: {e}")
+                self._dirty.set()  # 下一轮重试
 
     # ----------------------
     # 添加或更新绑定关系
@@ -82,19 +279,18 @@ class StorageManager:
         if watermark_paths is None:
             watermark_paths = {}
 
-        data = self._load()
-        playlist_base = f"{self.hls_output_dir}/{uid}"
-        playlist_no_wm = f"{playlist_base}_no_wm.m3u8"
-        playlist_wm = f"{playlist_base}_wm.m3u8"
-
-        data[uid] = {
-            "url": url,
-            "water_mark": watermark_paths,  # 改为 {wm_uid: path}
-            "hls_no_wm": playlist_no_wm,
-            "hls_wm": playlist_wm,
-            "status": status
-        }
-        self._save(data)
+        playlist_no_wm = self.get_hls_url(uid)
+        playlist_wm = f"{self.hls_output_dir}/{uid}_wm.m3u8"
+
+        with self._lock, self._uid_locks.setdefault(uid, threading.Lock()):
+            self._data[uid] = {
+                "url": url,
+                "water_mark": watermark_paths,  # 改为 {wm_uid: path}
+                "hls_no_wm": playlist_no_wm,
+                "hls_wm": playlist_wm,
+                "status": status
+            }
+            self._mark_dirty(uid)
 
     # ----------------------
     # 更新流默认水印
@@ -106,14 +302,14 @@ class StorageManager:
         :param watermark_paths: dict {wm_uid: path}
         :return: True 更新成功，False UID不存在
         """
-        data = self._load()
-        stream_data = data.get(uid)
-        if not stream_data:
-            return False
+        with self._uid_lock(uid):
+            stream_data = self._data.get(uid)
+            if not stream_data:
+                return False
 
-        stream_data["water_mark"] = watermark_paths
-        self._save(data)
-        return True
+            stream_data["water_mark"] = watermark_paths
+            self._mark_dirty(uid)
+            return True
 
     # ----------------------
     # 更新指定围栏/水印
@@ -126,17 +322,17 @@ class StorageManager:
         :param watermark_path: 文件路径
         :return: True 更新成功，False UID不存在
         """
-        data = self._load()
-        stream_data = data.get(uid)
-        if not stream_data:
-            return False
-
-        if "water_mark" not in stream_data:
-            stream_data["water_mark"] = {}
-
-        stream_data["water_mark"][wm_uid] = watermark_path
-        self._save(data)
-        return True
+        with self._uid_lock(uid):
+            stream_data = self._data.get(uid)
+            if not stream_data:
+                return False
+
+            # 整体替换 dict，避免修改到已被读取方拿走的旧对象
+            water_mark = dict(stream_data.get("water_mark") or {})
+            water_mark[wm_uid] = watermark_path
+            stream_data["water_mark"] = water_mark
+            self._mark_dirty(uid)
+            return True
 
 
 
@@ -144,28 +340,30 @@ class StorageManager:
     # 更新url
     # ----------------------
     def update_url(self, uid, url):
-        data = self._load()
-        data[uid]["url"] = url
-        self._save(data)
-        return True
+        with self._uid_lock(uid):
+            self._data[uid]["url"] = url
+            self._mark_dirty(uid)
+            return True
 
 
     # ----------------------
     # 删除绑定
     # ----------------------
     def remove_binding(self, uid):
-        data = self._load()
-        if uid in data:
-            del data[uid]
-            self._save(data)
+        with self._lock, self._uid_lock(uid):
+            if uid in self._data:
+                del self._data[uid]
+                del self._uid_locks[uid]
+                self._mark_removed(uid)
 
 
     # ----------------------
     # 查询信息
     # ----------------------
     def get_info(self, uid):
-        data = self._load()
-        return data.get(uid, None)
+        with self._uid_lock(uid):
+            info = self._data.get(uid)
+            return dict(info) if info is not None else None
 
     def get_status(self, uid):
         info = self.get_info(uid)
@@ -183,60 +381,96 @@ class StorageManager:
 
 
     def get_hls_url(self, uid):
-        info = self.get_info(uid)
-        return info["hls_no_wm"] if info else None
+        # 播放地址只由 uid 决定，直接拼接，无需查询绑定数据
+        if uid is None:
+            return None
+        return f"{self.hls_output_dir}/{uid}_no_wm.m3u8"
 
 
     def list_bindings(self):
-        return self._load()
+        # 返回浅拷贝，调用方遍历时不受其它线程写入影响
+        with self._lock:
+            return {uid: dict(info) for uid, info in self._data.items()}
+
+    def snapshot(self, *fields):
+        """
+        轻量快照：返回 [(uid, 字段1, 字段2, ...)]，只取需要的字段，不复制整条绑定
+        字段值为共享对象，调用方不应修改
+        """
+        get = operator.itemgetter(*fields)
+        with self._lock:
+            if len(fields) == 1:
+                return [(uid, get(info)) for uid, info in self._data.items()]
+            return [(uid, *get(info)) for uid, info in self._data.items()]
+
+    def list_bindings_since(self, since=None):
+        """
+        增量查询：返回 (当前版本, 版本 since 之后修改过的绑定 {uid: info}, 之后删除的 uid 集合)
+        调用方保存返回的版本，下次传入即可只取变化部分
+        since 为 None 或早于已丢弃的删除记录时为全量同步：返回全部绑定，删除集合为 None，
+        调用方应把不在返回结果中的 uid 都视为已删除
+        """
+        with self._lock:
+            with self._dirty_lock:
+                version = self.version
+                if since is None or since < self._tombstone_floor:
+                    changed = list(self._data)
+                    removed = None
+                else:
+                    changed = [uid for uid, v in self._changed_at.items() if v > since]
+                    removed = {uid for uid, v in self._removed_at.items() if v > since}
+            return version, {uid: dict(self._data[uid]) for uid in changed if uid in self._data}, removed
 
 
     # ----------------------
     # 更新状态
     # ----------------------
     def update_status(self, uid, status):
-        data = self._load()
-        if uid in data:
-            data[uid]["status"] = status
-            self._save(data)
-            return True
-        return False
+        with self._uid_lock(uid):
+            if uid in self._data:
+                self._data[uid]["status"] = status
+                self._mark_dirty(uid)
+                return True
+            return False
 
     # ----------------------
     # 更新所有流的状态
     # ----------------------
     def update_all_status(self, status):
-        data = self._load()
-        updated = False
-        for uid in data:
-            if data[uid].get("status") != status:
-                data[uid]["status"] = status
-                updated = True
-        if updated:
-            self._save(data)
-        return updated
+        with self._lock:
+            updated = False
+            for uid, info in self._data.items():
+                with self._uid_locks[uid]:
+                    if info.get("status") != status:
+                        info["status"] = status
+                        self._mark_dirty(uid)
+                        updated = True
+            return updated
 
 
     # ----------------------
     # 清空水印
     # ----------------------
     def clear_watermarks(self, uid):
-        data = self._load()
-        stream_data = data.get(uid)
-        if not stream_data:
-            return False
-
-        wm_dict = stream_data.get("water_mark", {})
-        for wm_path in wm_dict.values():
-            try:
-                if wm_path and os.path.exists(wm_path):
+        with self._uid_lock(uid):
+            stream_data = self._data.get(uid)
+            if not stream_data:
+                return False
+
+            wm_dict = stream_data.get("water_mark", {})
+            for wm_path in wm_dict.values():
+                if not wm_path:
+                    continue
+                try:
                     os.remove(wm_path)
-            except Exception as e:
-                print(f"[WARN] 删除水印文件失败: {wm_path}, 错误: {e}")
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"[WARN] 删除水印文件失败: {wm_path}, 错误: {e}")
 
-        stream_data["water_mark"] = {}
-        self._save(data)
-        return True
+            stream_data["water_mark"] = {}
+            self._mark_dirty(uid)
+            return True
 
 
 sm = StorageManager()
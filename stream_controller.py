@@ -1,19 +1,144 @@
 import platform
+import functools
 import subprocess
 import os
+import re
 import signal
+import selectors
 import threading
 import time
 import hashlib
+import json
+import shutil
+import mmap
 import traceback
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Optional
 import psutil
+try:
+    from blake3 import blake3 as _fingerprint_hash
+except ImportError:  # 未安装 blake3 时使用标准库 blake2b
+    _fingerprint_hash = hashlib.blake2b
 from storage import sm
-from utils.utils import log
+from config import DEVICE_CACHE_FILE, FFMPEG_CUDA_PIPELINE, MAX_CONCURRENT_STREAMS, HLS_COPY_NO_WM
+from utils.utils import log, log_multiline
 from utils.init_ffmpeg import init_ffmpeg
 
 FFMPEG_PATH = init_ffmpeg()
 
+# 超过该大小的水印文件用 mmap 计算指纹
+MMAP_HASH_THRESHOLD = 1 << 20
+
+# 水印指纹计算线程池，hashlib/blake3 计算时释放 GIL，可并行
+_HASH_POOL = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix="wm-hash")
+
+# 管理线程巡检间隔（秒）：有操作后从最小值开始，空闲时逐轮翻倍到兜底间隔；状态变化会立即唤醒
+MANAGER_POLL_MIN = 1
+MANAGER_POLL_INTERVAL = 30
+
+# 扫描未知 ffmpeg 的间隔（秒），有绑定被删除时立即扫描
+KILL_UNKNOWN_INTERVAL = 60
+
+# 进程异常退出后，隔多久（秒）再检查一次
+CRASH_RECHECK_DELAY = 60
+
+# 这些状态下不监控水印变化
+INACTIVE_STATUSES = frozenset(("need_stop", "stopped", "stopping"))
+# 占用 ffmpeg 进程名额的状态
+RUNNING_STATUSES = frozenset(("starting", "started", "need_restart"))
+
+# 重启时等待旧进程退出的最长时间（秒），超时强制结束，新进程才会写同一个播放列表和分片
+PLAYLIST_RELEASE_TIMEOUT = 2
+
+# 日志文件路径在导入时确定一次，管理线程和监控线程写同一个文件
+LOG_FILE_PATH = os.path.join("logs", datetime.now().strftime("%Y-%m-%d_%H-%M-%S"), "stream_controller.log")
+os.makedirs(os.path.dirname(LOG_FILE_PATH), exist_ok=True)
+
+# 每次从 ffmpeg stderr 原始 fd 读取的最大字节数，按块读取减少 read 系统调用
+STDERR_READ_SIZE = 64 * 1024
+
+# 每个 ffmpeg 放到独立的进程组/会话，停止时可连同其子进程一起结束
+if os.name == "nt":
+    _POPEN_GROUP_KWARGS = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+else:
+    _POPEN_GROUP_KWARGS = {"start_new_session": True}
+
+
+def _request_exit(process):
+    """
+    请求进程正常退出，让 ffmpeg 写完最后的分片和播放列表
+    Windows 上 terminate() 会直接结束进程，改为向独立进程组发送 CTRL_BREAK（ffmpeg 会正常收尾）
+    """
+    if os.name == "nt":
+        try:
+            process.send_signal(signal.CTRL_BREAK_EVENT)
+            return
+        except OSError:  # 没有控制台（如作为服务运行）时无法发送，直接结束
+            pass
+    process.terminate()
+
+
+def _kill_process_group(process):
+    """强制结束进程及其所在进程组"""
+    try:
+        if os.name == "nt":
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+@dataclass(slots=True)
+class StreamState:
+    """单路流的运行时状态，进程、监控缓存和异常计数放在一起，避免多个字典各自增删不同步"""
+    process: Optional[subprocess.Popen] = None
+    wm_paths: dict = field(default_factory=dict)  # wm_uid -> 水印路径
+    wm_hashes: Optional[dict] = field(default_factory=dict)  # wm_uid -> 水印文件指纹；None 表示流停止期间未跟踪、需要刷新
+    url: Optional[str] = None
+    error_count: int = 0  # 连续异常退出次数
+    status: Optional[str] = None  # 管理线程看到的最新状态，随增量更新；None 表示尚未同步
+    next_check: float = 0.0  # 异常退出后下次检查的时间（time.monotonic）
+    watched: Optional[subprocess.Popen] = None  # pidfd 已注册且尚未报告退出的进程，可确定仍在运行
+
+
+# Linux 下直接读 /proc，避免 psutil 为每个进程构造对象并读取多个文件
+_HAS_PROCFS = os.path.exists("/proc/self/comm")
+
+
+def _list_pids():
+    """当前所有进程的 pid，Linux 直接遍历 /proc"""
+    if _HAS_PROCFS:
+        with os.scandir("/proc") as it:
+            return [int(entry.name) for entry in it if entry.name.isdigit()]
+    return psutil.pids()
+
+
+def _process_name(pid):
+    """进程名，Linux 只读 /proc/<pid>/comm 一个文件"""
+    if _HAS_PROCFS:
+        with open(f"/proc/{pid}/comm", "rb") as f:
+            return f.read().strip().decode(errors="ignore")
+    return psutil.Process(pid).name()
+
+
+def _process_cmdline(pid):
+    """进程命令行（参数以空格拼接）"""
+    if _HAS_PROCFS:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            args = f.read().rstrip(b"\0").split(b"\0")
+        return " ".join(arg.decode(errors="ignore") for arg in args)
+    return " ".join(psutil.Process(pid).cmdline())
+
+
+def _terminate_pid(pid):
+    if os.name == "nt":
+        psutil.Process(pid).terminate()
+    else:
+        os.kill(pid, signal.SIGTERM)
+
 
 class FFmpegProcessManager:
     """
@@ -21,115 +146,248 @@ class FFmpegProcessManager:
     负责启动/停止/重启/清理未知 ffmpeg 进程
     """
 
-    def __init__(self, storage_manager, use_gpu=True, has_gpu=False, device_name="CPU"):
+    def __init__(self, storage_manager, states, use_gpu=True, has_gpu=False, device_name="CPU"):
         self.sm = storage_manager
         self.use_gpu = use_gpu
         self.has_gpu = has_gpu
         self.device_name = device_name
-        self.processes = {}  # uid -> subprocess.Popen
+        self.states = states  # uid -> StreamState，与 StreamController 共用
         self.running = True
+        self._known_pids = set()  # 已确认不是 ffmpeg 的进程，之后的扫描直接跳过
+        self._ffmpeg_cmdlines = {}  # pid -> ffmpeg 命令行，避免每轮重复读取
+        self._uid_pattern = (None, None)  # (uid 集合, 编译后的匹配正则)，uid 不变时复用
+        self._cmd_cache = {}  # uid -> (配置, ffmpeg 命令)
+        self._pending_starts = {}  # uid -> info，超过进程上限时按请求顺序排队等待启动
+        self._stopping_pids = set()  # 正在由本管理器停止、等待退出的进程，未知进程扫描时跳过
+        # GPU 全流程：解码、叠加水印、编码都在显存中完成
+        self.cuda_pipeline = bool(use_gpu and has_gpu and FFMPEG_CUDA_PIPELINE and has_cuda_filters())
+        self._wake = threading.Event()
+        self.sm.add_listener(self._wake.set)
+
+        # POSIX 下所有 ffmpeg 的 stderr 和进程退出事件（Linux pidfd）由一个线程通过 selector 统一等待；
+        # Windows 的 select 不支持管道，仍为每个进程开一个读取线程
+        self._selector = selectors.DefaultSelector() if os.name != "nt" else None
+        if self._selector:
+            threading.Thread(target=self._io_loop, daemon=True).start()
 
-        # 日志目录
-        now = datetime.now()
-        date_str = now.strftime("%Y-%m-%d_%H-%M-%S")
-        log_dir = os.path.join("logs", date_str)
-        os.makedirs(log_dir, exist_ok=True)
-        self.log_file_path = os.path.join(log_dir, "stream_controller.log")
+        self.log_file_path = LOG_FILE_PATH
 
         threading.Thread(target=self._auto_manager_loop, daemon=True).start()
 
     # ------------------------------------
     # 主循环：周期检测并根据状态操作
     # ------------------------------------
+    def _state(self, uid):
+        state = self.states.get(uid)
+        if state is None:
+            state = self.states[uid] = StreamState()
+        return state
+
     def _auto_manager_loop(self):
-        # 保存异常次数
-        error_counts = {}  # uid -> 异常次数
+        last_version = None  # 已处理到的数据版本，None 表示尚未取过全量
+        bound_uids = set()
+        poll_interval = MANAGER_POLL_MIN
+        next_scan = 0.0  # 下次扫描未知 ffmpeg 的时间（time.monotonic）
 
         while self.running:
             try:
-                bindings = self.sm.list_bindings()
-                valid_uids = set(bindings.keys())
-                # 清理未知 ffmpeg
-                self._kill_unknown_ffmpeg(valid_uids)
-
-                for uid, info in bindings.items():
-                    status = info.get("status")
-
-                    if status == "need_start":
-                        self.sm.update_status(uid, "starting")
-                        log("INFO", f"{uid} 启动中...", log_path=self.log_file_path)
-                        self._start_ffmpeg(uid, info)
-                        self.sm.update_status(uid, "started")
-                        error_counts[uid] = 0  # 启动成功，重置异常计数
-
-                    elif status == "need_stop":
-                        self.sm.update_status(uid, "stopping")
-                        log("INFO", f"{uid} 停止中...", log_path=self.log_file_path)
-                        self._stop_ffmpeg(uid)
-                        self.sm.update_status(uid, "stopped")
-                        error_counts[uid] = 0  # 停止成功，重置异常计数
-
-                    elif status == "need_restart":
-                        self.sm.update_status(uid, "starting")
-                        log("INFO", f"{uid} 重启中...", log_path=self.log_file_path)
-                        self._stop_ffmpeg(uid)
-                        self._start_ffmpeg(uid, info)
-                        self.sm.update_status(uid, "started")
-                        error_counts[uid] = 0  # 重启成功，重置异常计数
-
-                    elif status == "started":
-                        proc = self.processes.get(uid)
-                        if proc is None or proc.poll() is not None:
-                            # 异常退出，增加计数
-                            error_counts[uid] = error_counts.get(uid, 0) + 1
-                            log("WARN", f"[监控] {uid} 异常退出，计数 {error_counts[uid]}", log_path=self.log_file_path)
-
-                            # 如果连续异常 >= 3，标记 need_restart
-                            if error_counts[uid] >= 3:
-                                log("FAIL", f"[监控] {uid} 异常退出 3 次，标记 need_restart", log_path=self.log_file_path)
-                                self.sm.update_status(uid, "need_restart")
-                                error_counts[uid] = 0  # 重置计数
-                            else:
-                                # 等待 60 秒再检测下一轮
-                                time.sleep(60)
-                        else:
-                            # 正常运行，重置异常计数
-                            error_counts[uid] = 0
-
-                # 每轮循环可以加短延迟，避免 CPU 占用过高
-                time.sleep(1)
+                # 先清除唤醒标记再取增量，期间发生的变化会让下一轮立即执行
+                self._wake.clear()
+                version, changed, removed = self.sm.list_bindings_since(last_version)
+                if removed is None:  # 全量同步：不在结果中的 uid 都已解绑
+                    removed = bound_uids - changed.keys()
+                bound_uids -= removed
+                bound_uids |= changed.keys()
+                for uid in removed:
+                    self._pending_starts.pop(uid, None)
+                    self._cmd_cache.pop(uid, None)
+                    state = self.states.get(uid)
+                    if state:
+                        # 解绑时停止一次并回收进程，不留给未知进程扫描去 kill（那样没人 wait，会残留僵尸进程）
+                        if state.process is not None:
+                            self._stop_ffmpeg(uid, wait=False)
+                        # 状态不再保留，避免随绑定过的 uid 数量无限增长
+                        self.states.pop(uid, None)
+                did_work = bool(removed)
+
+                # 清理未知 ffmpeg：不需要秒级响应，按固定间隔扫描
+                if removed or time.monotonic() >= next_scan:
+                    did_work |= self._kill_unknown_ffmpeg(bound_uids) > 0
+                    next_scan = time.monotonic() + KILL_UNKNOWN_INTERVAL
+
+                # 只处理有变化的流
+                for uid, info in changed.items():
+                    state = self._state(uid)
+                    state.status = info.get("status")
+                    # 排队期间配置变化会被标记为 need_restart，此时仍未启动，继续排队
+                    queued = state.status == "need_start" or (
+                        state.status == "need_restart" and uid in self._pending_starts
+                    )
+                    if queued and not self._has_free_slot():
+                        if uid not in self._pending_starts:
+                            log("INFO", f"{uid} 等待启动：已达到进程上限 {MAX_CONCURRENT_STREAMS}", log_path=self.log_file_path)
+                        self._pending_starts[uid] = info
+                        continue
+                    self._pending_starts.pop(uid, None)
+                    did_work |= self._apply_status(uid, state, info)
+
+                # 有流停止空出名额时，按排队顺序启动等待中的流
+                while self._pending_starts and self._has_free_slot():
+                    uid = next(iter(self._pending_starts))
+                    did_work |= self._apply_status(uid, self._state(uid), self._pending_starts.pop(uid))
+
+                # 运行中的流巡检进程是否存活，只看本地状态
+                now = time.monotonic()
+                next_due = None
+                for uid, state in list(self.states.items()):
+                    if state.status != "started":
+                        continue
+                    if now >= state.next_check:
+                        did_work |= self._check_process(uid, state, now)
+                    if state.next_check > now and (next_due is None or state.next_check < next_due):
+                        next_due = state.next_check
+
+                last_version = version
+
+                # 有操作时缩短巡检间隔，空闲时逐步放大；状态变化会立即唤醒
+                poll_interval = MANAGER_POLL_MIN if did_work else min(poll_interval * 2, MANAGER_POLL_INTERVAL)
+                timeout = poll_interval
+                if next_due is not None:
+                    timeout = min(timeout, next_due - now)
+                self._wake.wait(timeout=max(timeout, 0))
 
             except Exception as e:
                 log("ERROR", f"_auto_manager_loop 异常: {e}", log_path=self.log_file_path)
                 time.sleep(5)
 
+    def _has_free_slot(self):
+        """是否还能再启动一个 ffmpeg 进程（MAX_CONCURRENT_STREAMS 为 None 时不限制）"""
+        if MAX_CONCURRENT_STREAMS is None:
+            return True
+        running = sum(1 for state in self.states.values() if state.status in RUNNING_STATUSES)
+        return running < MAX_CONCURRENT_STREAMS
+
+    # ------------------------------------
+    # 根据状态启动/停止/重启
+    # ------------------------------------
+    def _apply_status(self, uid, state, info):
+        """执行 need_* 状态对应的操作，返回是否执行了操作"""
+        status = state.status
+
+        if status == "need_start":
+            self.sm.update_status(uid, "starting")
+            log("INFO", f"{uid} 启动中...", log_path=self.log_file_path)
+            self._start_ffmpeg(uid, info)
+            self.sm.update_status(uid, "started")
+            state.status = "started"  # 立即计入进程名额，不等下一轮增量
+            state.error_count = 0  # 启动成功，重置异常计数
+            state.next_check = 0.0
+            return True
+
+        elif status == "need_stop":
+            self.sm.update_status(uid, "stopping")
+            log("INFO", f"{uid} 停止中...", log_path=self.log_file_path)
+            self._stop_ffmpeg(uid)
+            self.sm.update_status(uid, "stopped")
+            state.error_count = 0  # 停止成功，重置异常计数
+            return True
+
+        elif status == "need_restart":
+            self.sm.update_status(uid, "starting")
+            log("INFO", f"{uid} 重启中...", log_path=self.log_file_path)
+            # 新旧进程写同一个播放列表和分片，必须等旧进程退出（超时强制结束）后再启动
+            self._stop_ffmpeg(uid, timeout=PLAYLIST_RELEASE_TIMEOUT)
+            self._start_ffmpeg(uid, info)
+            self.sm.update_status(uid, "started")
+            state.error_count = 0  # 重启成功，重置异常计数
+            state.next_check = 0.0
+            return True
+
+        return False
+
+    # ------------------------------------
+    # 检查运行中的进程
+    # ------------------------------------
+    def _check_process(self, uid, state, now):
+        """检查进程是否存活，返回是否发现异常"""
+        proc = state.process
+        # pidfd 尚未报告退出的进程一定还在运行，不必再调用 poll()（waitpid）
+        if proc is not None and proc is state.watched:
+            state.error_count = 0
+            return False
+        if proc is None or proc.poll() is not None:
+            # 异常退出，增加计数
+            state.error_count += 1
+            log("WARN", f"[监控] {uid} 异常退出，计数 {state.error_count}", log_path=self.log_file_path)
+
+            # 如果连续异常 >= 3，标记 need_restart
+            if state.error_count >= 3:
+                log("FAIL", f"[监控] {uid} 异常退出 3 次，标记 need_restart", log_path=self.log_file_path)
+                self.sm.update_status(uid, "need_restart")
+                state.error_count = 0  # 重置计数
+                state.next_check = 0.0
+            else:
+                # 60 秒后再检测，期间不阻塞其它流的处理
+                state.next_check = now + CRASH_RECHECK_DELAY
+            return True
+
+        # 正常运行，重置异常计数
+        state.error_count = 0
+        return False
+
     # ------------------------------------
     # 杀死陌生 ffmpeg 进程
     # ------------------------------------
+    def _compile_uid_pattern(self, valid_uids):
+        """把所有 uid 编译成一个正则，一次 search 代替逐个 uid 的 in 判断"""
+        uids = frozenset(valid_uids)
+        cached_uids, pattern = self._uid_pattern
+        if cached_uids != uids:
+            # 没有绑定时使用永不匹配的正则，所有 ffmpeg 都视为未知
+            pattern = re.compile("|".join(map(re.escape, uids)) if uids else r"(?!)")
+            self._uid_pattern = (uids, pattern)
+        return pattern
+
     def _kill_unknown_ffmpeg(self, valid_uids):
         try:
             killed = []
-            for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
+            uid_pattern = self._compile_uid_pattern(valid_uids)
+            pids = _list_pids()
+            alive = set(pids)
+            # 丢弃已退出进程的缓存
+            self._known_pids &= alive
+            for pid in self._ffmpeg_cmdlines.keys() - alive:
+                del self._ffmpeg_cmdlines[pid]
+
+            for pid in pids:
+                if pid in self._known_pids or pid in self._stopping_pids:
+                    continue
                 try:
-                    name = proc.info['name']
-                    cmdline = " ".join(proc.info['cmdline']) if proc.info['cmdline'] else ""
-                    if not name:
-                        continue
+                    cmdline = self._ffmpeg_cmdlines.get(pid)
+                    if cmdline is None:
+                        # 先只读进程名，只有 ffmpeg 才读取代价更高的命令行
+                        name = _process_name(pid)
+                        if not name or "ffmpeg" not in name.lower():
+                            self._known_pids.add(pid)
+                            continue
+                        cmdline = _process_cmdline(pid)
+                        self._ffmpeg_cmdlines[pid] = cmdline
 
-                    if "ffmpeg" in name.lower():
-                        if not any(uid in cmdline for uid in valid_uids):
-                            pid = proc.info['pid']
-                            killed.append(pid)
-                            proc.terminate()
-                            log("WARN", f"检测到未知 ffmpeg 进程 {pid}，正在终止", log_path=self.log_file_path)
-                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    if uid_pattern.search(cmdline) is None:
+                        killed.append(pid)
+                        _terminate_pid(pid)
+                        log("WARN", f"检测到未知 ffmpeg 进程 {pid}，正在终止", log_path=self.log_file_path)
+                except (psutil.NoSuchProcess, psutil.AccessDenied, OSError):
+                    # 进程已退出（/proc 文件不存在）或无权限
                     continue
 
             if killed:
                 log("INFO", f"已清理未知 ffmpeg 进程: {killed}", log_path=self.log_file_path)
+            return len(killed)
 
         except Exception as e:
             log("FAIL", f"杀死未知 ffmpeg 进程失败: {e}", log_path=self.log_file_path)
+            return 0
 
     # ------------------------------------
     # 启动 FFmpeg
@@ -138,68 +396,117 @@ class FFmpegProcessManager:
         try:
             log("INFO", f"启动 FFmpeg 进程 {uid}", log_path=self.log_file_path)
             # 检查是否已经有相同的进程在运行
-            if uid in self.processes:
-                process = self.processes[uid]
-                if process.poll() is None:  # 进程仍在运行
+            state = self._state(uid)
+            if state.process is not None:
+                if state.process.poll() is None:  # 进程仍在运行
                     log("INFO", f"FFmpeg 进程 {uid} 已经在运行，重启中", log_path=self.log_file_path)
                     self.sm.update_status(uid, "need_restart")
                     return  # 跳过启动操作
 
             # 继续启动新的 FFmpeg 进程
-            url = info.get("url")
-            watermarks = info.get("water_mark", {}) or {}
-            wm_paths = list(watermarks.values())
-            playlist_no_wm = info.get("hls_no_wm")
-            playlist_wm = info.get("hls_wm")
-
-            cmd = [FFMPEG_PATH, "-loglevel", "error", "-i", url]
-            for wm in wm_paths:
-                cmd += ["-i", wm]
-
-            if wm_paths:
-                filter_complex, last = self._build_filter(watermarks)
-                cmd += [
-                    "-filter_complex", filter_complex,
-                    "-map", last, "-map", "0:a?",
-                    *self._hls_output_args(playlist_wm, self.use_gpu and self.has_gpu),
-                    "-map", "0:v", "-map", "0:a?",
-                    *self._hls_output_args(playlist_no_wm, self.use_gpu and self.has_gpu)
-                ]
-            else:
-                cmd += [
-                    "-map", "0:v", "-map", "0:a?",
-                    *self._hls_output_args(playlist_no_wm, self.use_gpu and self.has_gpu)
-                ]
+            cmd = self._get_cmd(uid, info)
 
             # 启动新的进程
+            # stdout 不使用，丢弃以免管道写满阻塞 ffmpeg；
+            # stdin 同样接到 DEVNULL，避免 ffmpeg 读取继承来的终端输入
             process = subprocess.Popen(
                 cmd,
-                stdout=subprocess.PIPE,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
                 stderr=subprocess.PIPE,
-                bufsize=0
+                **_POPEN_GROUP_KWARGS
             )
-            self.processes[uid] = process
-            threading.Thread(target=self._capture_stderr, args=(uid, process), daemon=True).start()
+            state.process = process
+            if self._selector:
+                os.set_blocking(process.stderr.fileno(), False)
+                self._selector.register(process.stderr, selectors.EVENT_READ, data=(uid, bytearray()))
+                self._watch_exit(uid, process)
+            else:
+                threading.Thread(target=self._capture_stderr, args=(uid, process), daemon=True).start()
             log("SUCCESS", f"启动 FFmpeg 成功: {uid}", log_path=self.log_file_path)
 
         except Exception as e:
             log("FAIL", f"启动 {uid} 失败: {e}", log_path=self.log_file_path)
             self.sm.update_status(uid, "need_start")
 
+    # ------------------------------------
+    # 构建 FFmpeg 命令（按配置缓存，配置不变时重启直接复用）
+    # ------------------------------------
+    def _get_cmd(self, uid, info):
+        watermarks = info.get("water_mark", {}) or {}
+        key = (
+            info.get("url"), tuple(watermarks.values()),
+            info.get("hls_wm"), info.get("hls_no_wm"), self.use_gpu and self.has_gpu, self.cuda_pipeline,
+            HLS_COPY_NO_WM
+        )
+        cached = self._cmd_cache.get(uid)
+        if cached and cached[0] == key:
+            return cached[1]
+        cmd = self._build_cmd(*key)
+        self._cmd_cache[uid] = (key, cmd)
+        return cmd
+
+    @classmethod
+    def _build_cmd(cls, url, wm_paths, playlist_wm, playlist_no_wm, gpu, cuda=False, copy_no_wm=False):
+        cmd = [FFMPEG_PATH, "-loglevel", "error"]
+        if cuda:
+            # 视频源用 NVDEC 解码，帧留在显存中直到 NVENC 编码，不经过内存拷贝
+            cmd += cls._CUDA_INPUT_ARGS
+        cmd += ["-i", url]
+        for wm in wm_paths:
+            cmd += ["-i", wm]
+
+        if wm_paths:
+            filter_complex, last = cls._build_filter(len(wm_paths), cuda)
+            cmd += [
+                "-filter_complex", filter_complex,
+                "-map", last, "-map", "0:a?",
+                *cls._hls_output_args(playlist_wm, gpu),
+                "-map", "0:v", "-map", "0:a?",
+                *cls._hls_output_args(playlist_no_wm, gpu, copy_no_wm)
+            ]
+        else:
+            cmd += [
+                "-map", "0:v", "-map", "0:a?",
+                *cls._hls_output_args(playlist_no_wm, gpu, copy_no_wm)
+            ]
+        return cmd
+
     # ------------------------------------
     # 停止 FFmpeg
     # ------------------------------------
-    def _stop_ffmpeg(self, uid):
+    def _take_process(self, uid):
+        """取出并清空 uid 当前的进程对象"""
+        state = self.states.get(uid)
+        if state is None:
+            return None
+        process, state.process = state.process, None
+        return process
+
+    def _stop_ffmpeg(self, uid, wait=True, timeout=5):
+        """
+        wait=True 时等待进程退出，超过 timeout 秒强制结束；
+        wait=False 时发送终止信号后由后台线程等待退出（超时强制结束）
+        """
         try:
-            process = self.processes.pop(uid, None)
+            process = self._take_process(uid)
             if not process:
                 log("WARN", f"停止 {uid} 时未找到对应进程对象", log_path=self.log_file_path)
                 return
 
             # 检查进程是否仍在运行
             if process.poll() is None:
-                os.kill(process.pid, signal.SIGTERM)
                 log("INFO", f"停止转流 {uid}（PID={process.pid}）", log_path=self.log_file_path)
+                if wait:
+                    self._terminate(uid, process, timeout)
+                else:
+                    # 终止信号在这里立即发出，后台线程只负责等待退出和超时强制结束；
+                    # 退出前不让未知进程扫描把它当作陌生进程再终止一次
+                    self._stopping_pids.add(process.pid)
+                    _request_exit(process)
+                    threading.Thread(
+                        target=self._terminate, args=(uid, process), kwargs={"request": False}, daemon=True
+                    ).start()
             else:
                 log("INFO", f"{uid} 进程已退出，无需停止", log_path=self.log_file_path)
 
@@ -209,54 +516,399 @@ class FFmpegProcessManager:
         except Exception as e:
             log("FAIL", f"停止 {uid} 失败: {e}", log_path=self.log_file_path)
 
+    # ------------------------------------
+    # 同步停止 FFmpeg：等待进程真正退出后返回
+    # ------------------------------------
+    def stop_sync(self, uid, timeout=5):
+        """停止 uid 对应的 ffmpeg 并等待退出，返回被停止的进程，没有运行中的进程时返回 None"""
+        process = self._take_process(uid)
+        if not process:
+            return None
+        if process.poll() is None:
+            self._terminate(uid, process, timeout)
+        log("INFO", f"已停止转流 {uid}（PID={process.pid}）", log_path=self.log_file_path)
+        return process
 
     # ------------------------------------
-    # 捕获 FFmpeg stderr
+    # 服务退出时停止所有 FFmpeg
+    # ------------------------------------
+    def stop_all(self, timeout=5):
+        """
+        停止管理线程并结束所有 ffmpeg：ffmpeg 运行在独立会话中，收不到终端的 Ctrl+C/SIGHUP，
+        不在这里结束会在服务退出后继续运行
+        """
+        self.running = False
+        processes = [(uid, self._take_process(uid)) for uid in list(self.states)]
+        processes = [(uid, p) for uid, p in processes if p is not None and p.poll() is None]
+        # 先同时通知所有进程退出，再逐个等待，总耗时不超过一个 timeout
+        for _, process in processes:
+            _request_exit(process)
+        deadline = time.monotonic() + timeout
+        for uid, process in processes:
+            self._terminate(uid, process, max(deadline - time.monotonic(), 0), request=False)
+        if processes:
+            log("INFO", f"已停止全部转流，共 {len(processes)} 个 ffmpeg 进程", log_path=self.log_file_path)
+
+    # ------------------------------------
+    # 结束进程：先正常终止让 ffmpeg 写完播放列表，超时后强制结束整个进程组
+    # ------------------------------------
+    def _terminate(self, uid, process, timeout=5, request=True):
+        """request=False 表示调用方已发出终止信号，这里只等待"""
+        self._stopping_pids.add(process.pid)
+        try:
+            if request:
+                _request_exit(process)
+            try:
+                process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                log("WARN", f"{uid} 在 {timeout}s 内未退出，强制结束（PID={process.pid}）", log_path=self.log_file_path)
+                _kill_process_group(process)
+                process.wait()
+        finally:
+            self._stopping_pids.discard(process.pid)
+
+    # ------------------------------------
+    # 捕获 FFmpeg stderr（Windows：每个进程一个线程）
     # ------------------------------------
     def _capture_stderr(self, uid, process):
-        for line in iter(process.stderr.readline, b''):
-            if not line:
-                break
-            log("FAIL", f"[FFMPEG] {uid}: {line.decode(errors='ignore').strip()}",
-                log_path=self.log_file_path)
+        # 按大块读取原始 fd，再切分出完整行，不逐行 readline
+        fd = process.stderr.fileno()
+        pending = bytearray()
+        try:
+            while True:
+                chunk = os.read(fd, STDERR_READ_SIZE)
+                if not chunk:
+                    break
+                self._split_stderr(uid, pending, chunk)
+        except OSError:
+            pass
+        if pending:
+            self._log_stderr(uid, bytes(pending))
+        process.stderr.close()
+        # stderr 关闭即进程已退出，唤醒管理线程立即检查
+        self._wake.set()
+
+    # ------------------------------------
+    # 捕获 FFmpeg stderr / 进程退出（POSIX：单线程 selector）
+    # ------------------------------------
+    def _io_loop(self):
+        while self.running:
+            try:
+                # epoll/kqueue 在等待期间也能感知新注册的 fd，空闲时无需频繁醒来
+                for key, _ in self._selector.select(timeout=MANAGER_POLL_INTERVAL):
+                    # stderr 的 data 为 (uid, 未完整的行)，pidfd 的 data 为 (uid, None, 进程)
+                    if key.data[1] is None:
+                        self._on_process_exit(key)
+                    else:
+                        self._drain_stderr(key)
+            except Exception as e:
+                log("ERROR", f"_io_loop 异常: {e}", log_path=self.log_file_path)
+                time.sleep(1)
+
+    def _watch_exit(self, uid, process):
+        """Linux 5.3+ 用 pidfd 监听进程退出，退出时立即唤醒管理线程，不用等下一轮巡检"""
+        if not hasattr(os, "pidfd_open"):
+            return
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except OSError:  # 内核不支持或进程已退出
+            return
+        # 必须先标记再注册：进程已退出时 IO 线程可能在注册后立刻处理退出事件，
+        # 之后才标记会让 watched 永远不被清除，管理线程也就不再 poll() 这个已退出的进程
+        state = self._state(uid)
+        state.watched = process
+        try:
+            self._selector.register(pidfd, selectors.EVENT_READ, data=(uid, None, process))
+        except (OSError, ValueError):  # 注册失败时退回到管理线程 poll() 检查
+            state.watched = None
+            os.close(pidfd)
+
+    def _on_process_exit(self, key):
+        uid, _, process = key.data
+        self._selector.unregister(key.fd)
+        os.close(key.fd)
+        state = self.states.get(uid)
+        if state and state.watched is process:
+            state.watched = None
+        self._wake.set()
+
+    def _drain_stderr(self, key):
+        uid, pending = key.data
+        try:
+            chunk = os.read(key.fd, STDERR_READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b""
+
+        if not chunk:
+            # 进程已退出，输出剩余内容后注销并关闭管道
+            if pending:
+                self._log_stderr(uid, bytes(pending))
+            self._selector.unregister(key.fileobj)
+            key.fileobj.close()
+            # 没有 pidfd 的平台以 stderr 关闭作为进程退出信号
+            self._wake.set()
+            return
+
+        self._split_stderr(uid, pending, chunk)
+
+    def _split_stderr(self, uid, pending, chunk):
+        """把新读到的数据接到未完整的行后面，输出所有完整行，剩余部分留在 pending"""
+        pending.extend(chunk)
+        end = pending.rfind(b"\n")
+        if end < 0:
+            return
+        self._log_stderr(uid, pending[:end])
+        del pending[:end + 1]
+
+    def _log_stderr(self, uid, data):
+        """输出一段 stderr（可包含多行），整段只解码一次、写一次日志"""
+        lines = [line.strip() for line in data.decode(errors="ignore").split("\n")]
+        lines = [f"[FFMPEG] {uid}: {line}" for line in lines if line]
+        if len(lines) == 1:
+            log("FAIL", lines[0], log_path=self.log_file_path)
+        elif lines:
+            log_multiline("FAIL", *lines, log_path=self.log_file_path)
 
     # ------------------------------------
     # 构建水印滤镜
     # ------------------------------------
     @staticmethod
-    def _build_filter(watermark_paths):
-        filters = ""
+    @functools.lru_cache(maxsize=None)
+    def _build_filter(count, cuda=False):
+        """
+        按水印数量构建叠加滤镜，水印输入依次为 1..count 号输入；只与数量有关，按数量缓存
+        cuda=True 时水印图片转为 yuva420p 上传到显存，用 overlay_cuda 在显存中叠加
+        """
+        parts = []
         last = "[0:v]"
-        for i, path in enumerate(watermark_paths.values()):
-            filters += f"[{i + 1}:v]scale=iw:ih[wm{i}];"
-            filters += f"{last}[wm{i}]overlay=0:0:format=auto[v{i}];"
+        for i in range(count):
+            if cuda:
+                parts.append(f"[{i + 1}:v]format=yuva420p,hwupload_cuda[wm{i}]")
+                parts.append(f"{last}[wm{i}]overlay_cuda=0:0[v{i}]")
+            else:
+                # 水印按原尺寸叠加，直接使用输入，不经过 scale
+                parts.append(f"{last}[{i + 1}:v]overlay=0:0:format=auto[v{i}]")
             last = f"[v{i}]"
-        if filters.endswith(";"):
-            filters = filters[:-1]
-        return filters, last
+        return ";".join(parts), last
+
+    _CUDA_INPUT_ARGS = ("-hwaccel", "cuda", "-hwaccel_output_format", "cuda")
 
     # ------------------------------------
-    # 输出 HLS 参数
+    # 输出 HLS 参数（除播放列表路径外都是常量，预先构建）
     # ------------------------------------
-    @staticmethod
-    def _hls_output_args(playlist, gpu=False):
-        if gpu:
-            vcodec = ["-c:v", "h264_nvenc", "-preset", "p2", "-cq", "19"]
-        else:
-            vcodec = ["-c:v", "libx264", "-preset", "medium", "-crf", "20"]
-        return [
-            *vcodec,
-            "-r", "10",
-            "-b:v", "3000k",
-            "-maxrate", "4000k",
-            "-bufsize", "10000k",
-            "-c:a", "aac",
-            "-f", "hls",
-            "-hls_time", "5",
-            "-hls_list_size", "5",
-            "-hls_flags", "delete_segments",
-            playlist
-        ]
+    # NVENC 低延迟 CBR：码率由下方 -b:v 决定，单路编码更快，同一块 GPU 可承载更多路
+    _VCODEC_GPU = ("-c:v", "h264_nvenc", "-preset", "p1", "-tune", "ll", "-rc", "cbr", "-zerolatency", "1")
+    _VCODEC_CPU = ("-c:v", "libx264", "-preset", "medium", "-crf", "20")
+    _VCODEC_COPY = ("-c:v", "copy")
+    _VIDEO_RATE = (
+        "-r", "10",
+        "-b:v", "3000k",
+        "-maxrate", "4000k",
+        "-bufsize", "10000k",
+    )
+    # 音频仍转为 aac：摄像头常见的 G.711 等编码不能直接放进 HLS
+    _HLS_TAIL = (
+        "-c:a", "aac",
+        "-f", "hls",
+        "-hls_time", "5",
+        "-hls_list_size", "5",
+        # temp_file：分片先写到 .tmp 再改名，客户端不会读到写了一半的分片
+        "-hls_flags", "delete_segments+temp_file+independent_segments",
+    )
+
+    _HLS_ARGS_GPU = _VCODEC_GPU + _VIDEO_RATE + _HLS_TAIL
+    _HLS_ARGS_CPU = _VCODEC_CPU + _VIDEO_RATE + _HLS_TAIL
+    _HLS_ARGS_COPY = _VCODEC_COPY + _HLS_TAIL
+
+    @classmethod
+    def _hls_output_args(cls, playlist, gpu=False, copy=False):
+        """copy=True 时视频流直接复制，不解码、不重编码"""
+        if copy:
+            return (*cls._HLS_ARGS_COPY, playlist)
+        return (*(cls._HLS_ARGS_GPU if gpu else cls._HLS_ARGS_CPU), playlist)
+
+
+def _hash_file(path, size):
+    """计算文件指纹（BLAKE3，未安装时为 blake2b）"""
+    if size > MMAP_HASH_THRESHOLD and hasattr(_fingerprint_hash, "update_mmap"):
+        # blake3 自带 mmap 接口，大文件零拷贝并多线程计算
+        h = _fingerprint_hash(max_threads=_fingerprint_hash.AUTO)
+        h.update_mmap(path)
+        return h.hexdigest()
+
+    with open(path, "rb", buffering=0) as f:
+        if size > MMAP_HASH_THRESHOLD:
+            # 大文件映射到内存直接计算，页面不复制到 Python 堆
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, "madvise"):  # 顺序读取，让内核提前预读后续页面
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                return _fingerprint_hash(mm).hexdigest()
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, _fingerprint_hash).hexdigest()
+        # 复用同一块缓冲区读取，不为每个分块分配新的 bytes
+        h = _fingerprint_hash()
+        buf = bytearray(64 * 1024)
+        view = memoryview(buf)
+        while n := f.readinto(buf):
+            h.update(view[:n])
+        return h.hexdigest()
+
+
+def _try_hash_file(path, size):
+    """线程池中使用：文件在 stat 之后被删除时返回 None"""
+    try:
+        return _hash_file(path, size)
+    except OSError:
+        return None
+
+
+_CPU_MODEL_RE = re.compile(rb"^model name\s*:\s*(.+)$", re.M)
+
+
+# ----------------------
+# 检测系统设备（GPU 或 CPU），硬件信息运行期间不变，只检测一次；
+# 结果同时缓存到磁盘，ffmpeg 和 NVIDIA 驱动未变化时重启服务不再重新检测
+# ----------------------
+@functools.lru_cache(maxsize=None)
+def check_device(use_gpu=True):
+    """ 检查系统设备（GPU 或 CPU），返回 (是否启用GPU, 设备名称) """
+    try:
+        return tuple(_cached_probe(f"device_gpu={use_gpu}", lambda: list(_detect_device(use_gpu))))
+    except Exception as e:
+        log("FAIL", f"检测设备异常: {e}", log_path=LOG_FILE_PATH)
+        return False, "未知"
+
+
+def _cached_probe(name, probe):
+    """
+    读取磁盘缓存中名为 name 的检测结果，ffmpeg 或驱动变化后重新调用 probe() 检测并保存
+    probe 抛出异常时不缓存
+    """
+    key = _device_cache_key()
+    cache = _load_device_cache()
+    entry = cache.get(name)
+    if entry and entry.get("key") == key:
+        return entry["result"]
+    result = probe()
+    cache[name] = {"key": key, "result": result}
+    _save_device_cache(cache)
+    return result
+
+
+def _device_cache_key():
+    """ffmpeg 可执行文件（路径 + 修改时间）和 NVIDIA 驱动版本，任一变化都需要重新检测"""
+    ffmpeg = shutil.which(FFMPEG_PATH) or FFMPEG_PATH
+    try:
+        ffmpeg_mtime = os.stat(ffmpeg).st_mtime_ns
+    except OSError:
+        ffmpeg_mtime = None
+    try:
+        with open("/proc/driver/nvidia/version", encoding="utf-8", errors="ignore") as f:
+            driver = f.read().strip()
+    except OSError:
+        driver = ""
+    return [ffmpeg, ffmpeg_mtime, driver]
+
+
+def _load_device_cache():
+    """{检测项: {"key": 缓存键, "result": 结果}}，文件不存在或损坏时返回空 dict"""
+    try:
+        with open(DEVICE_CACHE_FILE, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _save_device_cache(data):
+    tmp_path = f"{DEVICE_CACHE_FILE}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, DEVICE_CACHE_FILE)
+    except OSError as e:
+        log("WARN", f"保存设备检测缓存失败: {e}", log_path=LOG_FILE_PATH)
+
+
+@functools.lru_cache(maxsize=None)
+def has_cuda_filters():
+    """ffmpeg 是否带有 hwupload_cuda / overlay_cuda 滤镜（在显存中叠加水印需要）"""
+    return _cached_probe("cuda_filters", _probe_cuda_filters)
+
+
+def _probe_cuda_filters():
+    try:
+        result = subprocess.run(
+            [FFMPEG_PATH, "-hide_banner", "-filters"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+    except OSError:
+        return False
+    return b"hwupload_cuda" in result.stdout and b"overlay_cuda" in result.stdout
+
+
+def _detect_device(use_gpu):
+    """实际检测：运行 ffmpeg -encoders / nvidia-smi，读取 CPU 型号；出错时抛出异常，由 check_device 处理"""
+    # 默认结果
+    has_gpu = False
+    device_name = "未知"
+
+    # 检查 ffmpeg 是否支持 GPU 编码（直接在字节中查找，不解码整段输出）
+    result = subprocess.run(
+        [FFMPEG_PATH, "-hide_banner", "-encoders"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+    )
+    has_gpu = b"h264_nvenc" in result.stdout
+
+    # 获取系统平台
+    system = platform.system().lower()
+
+    # 优先检测 GPU（如果启用）
+    if has_gpu and use_gpu:
+        try:
+            smi_result = subprocess.run(
+                ["nvidia-smi", "--query-gpu=name", "--format=csv,noheader"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            )
+            gpu_name = smi_result.stdout.decode(errors="ignore").strip()
+            if gpu_name:
+                device_name = gpu_name
+            else:
+                device_name = "NVIDIA GPU (未知型号)"
+                use_gpu = False
+        except Exception:
+            device_name = "GPU 可用但无法通过 nvidia-smi 获取名称"
+            use_gpu = False
+    if not use_gpu:
+        # 检测 CPU 型号
+        try:
+            if system == "windows":
+                # Windows 平台：从注册表读取 CPU 型号，不启动 wmic 进程
+                import winreg
+                try:
+                    with winreg.OpenKey(
+                        winreg.HKEY_LOCAL_MACHINE, r"HARDWARE\DESCRIPTION\System\CentralProcessor\0"
+                    ) as key:
+                        device_name = winreg.QueryValueEx(key, "ProcessorNameString")[0].strip()
+                except OSError:
+                    device_name = platform.processor() or "CPU (型号未知)"
+            elif system == "linux":
+                # Linux 平台：第一个 CPU 的信息在文件开头，只读前 4KB 用正则取型号
+                with open("/proc/cpuinfo", "rb") as f:
+                    match = _CPU_MODEL_RE.search(f.read(4096))
+                if match:
+                    device_name = match.group(1).decode(errors="ignore").strip()
+            else:
+                device_name = f"未知系统: {system}"
+        except Exception:
+            device_name = "CPU (型号未知)"
+
+    return has_gpu and use_gpu, device_name
 
 
 class StreamController:
@@ -264,157 +916,199 @@ class StreamController:
 
     def __init__(self, sm):
         self.sm = sm
-        self.wm_paths_cache = {}
-        self.wm_md5_cache = {}
-        self.url_cache = {}
+        self.states = {}  # uid -> StreamState
+        self._hash_stat_cache = {}  # path -> ((ino, mtime_ns, size), 指纹)，文件未变化时不重复读取
+        self._monitor_thread = None
+        self._monitor_lock = threading.Lock()
+        # 绑定或水印通过接口修改时立即唤醒监控线程；定时轮询只用于发现磁盘上被直接替换的水印文件
+        self._monitor_wake = threading.Event()
+        self.sm.add_listener(self._monitor_wake.set)
 
         self.use_gpu = True
-        self.has_gpu, self.device_name = self.check_device()
-        now = datetime.now()
-        log_dir = os.path.join("logs", now.strftime("%Y-%m-%d_%H-%M-%S"))
-        os.makedirs(log_dir, exist_ok=True)
-        self.log_file_path = os.path.join(log_dir, "stream_controller.log")
+        self.has_gpu, self.device_name = check_device()
+        self.log_file_path = LOG_FILE_PATH
 
         # 初始化缓存
+        seen = {}
         for uid, info in self.sm.list_bindings().items():
-            watermarks = info.get("water_mark", {}) or {}
-            self.wm_paths_cache[uid] = dict(watermarks)
-            self.wm_md5_cache[uid] = {wm_uid: self._file_md5(p) for wm_uid, p in watermarks.items()}
-            self.url_cache[uid] = info.get("url")
+            self._update_cache(uid, info.get("url"), info.get("water_mark"), seen)
 
         # 启动独立进程管理器
         self.process_manager = FFmpegProcessManager(
             storage_manager=self.sm,
+            states=self.states,
             use_gpu=self.use_gpu,
             has_gpu=self.has_gpu,
             device_name=self.device_name
         )
 
     # ----------------------
-    # 检测系统设备（GPU 或 CPU）
+    # 同步停止转流
     # ----------------------
-    def check_device(self, use_gpu=True):
-        """ 检查系统设备（GPU 或 CPU），返回 (是否启用GPU, 设备名称) """
-        try:
-            import platform
+    def stop_stream_sync(self, uid, timeout=5):
+        """立即停止转流并等待 ffmpeg 退出（释放水印等文件句柄），返回被停止的进程"""
+        return self.process_manager.stop_sync(uid, timeout)
 
-            # 默认结果
-            has_gpu = False
-            device_name = "未知"
+    def stop_all(self, timeout=5):
+        """服务退出时结束所有 ffmpeg 进程"""
+        self.process_manager.stop_all(timeout)
 
-            # 检查 ffmpeg 是否支持 GPU 编码
-            result = subprocess.run(
-                [FFMPEG_PATH, "-hide_banner", "-encoders"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            has_gpu = "h264_nvenc" in result.stdout
+    # ----------------------
+    # 正在运行的转流
+    # ----------------------
+    def list_running(self):
+        """返回 ffmpeg 进程仍在运行的流 {uid: pid}"""
+        return {
+            uid: state.process.pid
+            for uid, state in list(self.states.items())
+            if state.process is not None and state.process.poll() is None
+        }
 
-            # 获取系统平台
-            system = platform.system().lower()
+    # ----------------------
+    # 缓存
+    # ----------------------
+    def _update_cache(self, uid, url, watermarks, seen=None, hashes=None):
+        """hashes: 调用方已算好的 {wm_uid: 指纹}，提供时直接使用"""
+        watermarks = watermarks or {}
+        state = self.states.get(uid)
+        if state is None:
+            state = self.states[uid] = StreamState()
+        # 直接保存引用：存储层不会原地修改水印 dict，只会整体替换
+        state.wm_paths = watermarks
+        if hashes is None:
+            hashes = {wm_uid: self._file_fingerprint(p, seen) for wm_uid, p in watermarks.items()}
+        state.wm_hashes = hashes
+        state.url = url
 
-            # 优先检测 GPU（如果启用）
-            if has_gpu and use_gpu:
-                try:
-                    smi_result = subprocess.run(
-                        ["nvidia-smi", "--query-gpu=name", "--format=csv,noheader"],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True
-                    )
-                    gpu_name = smi_result.stdout.strip()
-                    if gpu_name:
-                        device_name = gpu_name
-                    else:
-                        device_name = "NVIDIA GPU (未知型号)"
-                        use_gpu = False
-                except Exception:
-                    device_name = "GPU 可用但无法通过 nvidia-smi 获取名称"
-                    use_gpu = False
-            if not use_gpu:
-                # 检测 CPU 型号
-                try:
-                    if system == "windows":
-                        # Windows 平台
-                        cpu_result = subprocess.run(
-                            ["wmic", "cpu", "get", "name"],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            text=True
-                        )
-                        lines = [l.strip() for l in cpu_result.stdout.splitlines() if l.strip()]
-                        if len(lines) > 1:
-                            device_name = lines[1]  # 第二行是CPU名称
-                        else:
-                            device_name = "CPU (型号未知)"
-                    elif system == "linux":
-                        # Linux 平台
-                        cpu_result = subprocess.run(
-                            ["cat", "/proc/cpuinfo"],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            text=True
-                        )
-                        for line in cpu_result.stdout.split('\n'):
-                            if "model name" in line:
-                                device_name = line.split(":")[1].strip()
-                                break
-                    else:
-                        device_name = f"未知系统: {system}"
-                except Exception:
-                    device_name = "CPU (型号未知)"
+    def refresh_cache(self, uid):
+        """按当前配置刷新缓存，用于调用方自行安排了重启、不需要监控线程再次触发的场景"""
+        info = self.sm.get_info(uid)
+        if info:
+            self._update_cache(uid, info.get("url"), info.get("water_mark"))
 
-            return has_gpu and use_gpu, device_name
+    def _file_fingerprint(self, path, seen=None):
+        """
+        文件指纹，文件不存在时返回 None
+        seen: 可选的 {path: 指纹}，同一轮扫描内多个流共用同一水印文件时只 stat/计算一次
+        """
+        if seen is not None and path in seen:
+            return seen[path]
+        digest = self._compute_fingerprint(path)
+        if seen is not None:
+            seen[path] = digest
+        return digest
 
-        except Exception as e:
-            log("FAIL", f"检测设备异常: {e}", log_path=self.log_file_path)
-            return False, "未知"
+    def _lookup_fingerprint(self, path):
+        """
+        stat 文件并查缓存，返回 (指纹, 需要重新计算时的 stat 签名)
+        命中缓存返回 (指纹, None)，文件不存在返回 (None, None)
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None, None
+        # 文件替换（inode 变化）、修改时间或大小变化时才重新计算
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        cached = self._hash_stat_cache.get(path)
+        if cached and cached[0] == key:
+            return cached[1], None
+        return None, key
 
-    @staticmethod
-    def _file_md5(path):
-        if not os.path.exists(path):
-            return None
-        with open(path, "rb") as f:
-            return hashlib.md5(f.read()).hexdigest()
+    def _compute_fingerprint(self, path):
+        digest, key = self._lookup_fingerprint(path)
+        if key is None:
+            return digest
+        # 不先判断文件是否存在：stat 之后文件被删除时 _try_hash_file 返回 None
+        digest = _try_hash_file(path, key[2])
+        if digest is not None:
+            self._hash_stat_cache[path] = (key, digest)
+        return digest
+
+    def _prefetch_fingerprints(self, paths, seen):
+        """一轮扫描开始前把需要重新计算的文件交给线程池并行计算，结果放入 seen"""
+        stale = {}
+        for path in paths:
+            if path in seen or path in stale:
+                continue
+            digest, key = self._lookup_fingerprint(path)
+            if key is None:
+                seen[path] = digest
+            else:
+                stale[path] = key
+        if not stale:
+            return
+        sizes = [key[2] for key in stale.values()]
+        for (path, key), digest in zip(stale.items(), _HASH_POOL.map(_try_hash_file, stale, sizes)):
+            if digest is not None:
+                self._hash_stat_cache[path] = (key, digest)
+            seen[path] = digest
+
+    def start_monitor(self, interval=10):
+        """启动监控线程，重复调用（如模块被重新导入）不会启动第二个"""
+        with self._monitor_lock:
+            if self._monitor_thread is None or not self._monitor_thread.is_alive():
+                self._monitor_thread = threading.Thread(
+                    target=self.monitor_watermarks, args=(interval,), daemon=True
+                )
+                self._monitor_thread.start()
+            return self._monitor_thread
 
     def monitor_watermarks(self, interval=10):
         """监控 URL 和水印变化"""
         while True:
-            for uid, info in self.sm.list_bindings().items():
-                watermarks = info.get("water_mark", {}) or {}
-                url = info.get("url")
-                cached_paths = self.wm_paths_cache.get(uid)
-                cached_md5s = self.wm_md5_cache.get(uid, {})
-                cached_url = self.url_cache.get(uid)
+            self._monitor_wake.clear()
+            seen = {}  # 本轮已计算的 {path: 指纹}
+            # 只取需要的字段，不复制每条绑定
+            snapshot = self.sm.snapshot("url", "water_mark", "status")
+            self._prefetch_fingerprints(
+                (path for _, _, watermarks, status in snapshot if status not in INACTIVE_STATUSES
+                 for path in (watermarks or {}).values()),
+                seen
+            )
+            for uid, url, watermarks, status in snapshot:
+                watermarks = watermarks or {}
+                state = self.states.get(uid)
+
+                # 已停止的流不读取水印文件，缓存标记为过期
+                if status in INACTIVE_STATUSES:
+                    if state:
+                        state.wm_hashes = None
+                    continue
+                # 停止期间未跟踪变化，流会按当前配置启动，只刷新缓存，不触发重启
+                if state and state.wm_hashes is None:
+                    self._update_cache(uid, url, watermarks, seen)
+                    continue
+
+                cached_paths = state.wm_paths if state else None
+                cached_hashes = state.wm_hashes if state else {}
+                cached_url = state.url if state else None
 
                 changed = False
                 changed_details = []
+                new_hashes = None
 
-                if url != cached_url or watermarks != cached_paths:
+                # 存储层修改水印时总是整体替换 dict，同一对象说明路径未变，省去逐项比较
+                paths_changed = watermarks is not cached_paths and watermarks != cached_paths
+                if url != cached_url or paths_changed:
                     changed = True
                     if url != cached_url:
                         changed_details.append(f"URL更新")
-                    if watermarks != cached_paths:
+                    if paths_changed:
                         changed_details.append(f"水印文件路径更新")
                 else:
-                    for wm_uid, path in watermarks.items():
-                        md5 = self._file_md5(path)
-                        if md5 != cached_md5s.get(wm_uid):
-                            changed = True
-                            changed_details.append(f"水印文件的 MD5 值发生变化")
-                            break
+                    # 指纹都已在本轮预先算好，这里只是查表；变化时直接沿用，不再重新计算
+                    new_hashes = {wm_uid: self._file_fingerprint(path, seen) for wm_uid, path in watermarks.items()}
+                    if new_hashes != cached_hashes:
+                        changed = True
+                        changed_details.append(f"水印文件内容发生变化")
 
                 if changed:
                     log_details = "; ".join(changed_details)
-                    if info.get("status") not in ("need_stop", "stopped", "stopping"):
-                        log("INFO", f"检测到 {uid} 的配置变化: {log_details}，更新状态", log_path=self.log_file_path)
-                        self.sm.update_status(uid, "need_restart")
-                    self.wm_paths_cache[uid] = dict(watermarks)
-                    self.wm_md5_cache[uid] = {wm_uid: self._file_md5(p) for wm_uid, p in watermarks.items()}
-                    self.url_cache[uid] = url
-
-            time.sleep(interval)
+                    log("INFO", f"检测到 {uid} 的配置变化: {log_details}，更新状态", log_path=self.log_file_path)
+                    self.sm.update_status(uid, "need_restart")
+                    self._update_cache(uid, url, watermarks, seen, new_hashes)
+
+            self._monitor_wake.wait(timeout=interval)
 
 
 sc = StreamController(sm)
@@ -0,0 +1,69 @@
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from utils.utils import log
+
+# 最多保留的任务记录数，超出后丢弃最早的记录
+MAX_TASK_RECORDS = 1000
+
+
+class TaskQueue:
+    """
+    后台任务队列：耗时操作放到线程池执行，接口立即返回任务 ID，
+    之后通过 get_task 查询任务状态和结果
+    """
+
+    def __init__(self, max_workers=4, max_records=MAX_TASK_RECORDS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="task")
+        self._tasks = OrderedDict()  # task_id -> 任务信息
+        self._lock = threading.Lock()
+        self._max_records = max_records
+
+    # ----------------------
+    # 提交任务
+    # ----------------------
+    def submit(self, name, func, *args, **kwargs):
+        task_id = str(uuid.uuid4())
+        with self._lock:
+            self._tasks[task_id] = {
+                "task_id": task_id,
+                "name": name,
+                "status": "pending",
+                "result": None,
+                "error": None
+            }
+            while len(self._tasks) > self._max_records:
+                self._tasks.popitem(last=False)
+        self._executor.submit(self._run, task_id, func, args, kwargs)
+        return task_id
+
+    # ----------------------
+    # 执行任务并记录结果
+    # ----------------------
+    def _run(self, task_id, func, args, kwargs):
+        self._update(task_id, status="running")
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            log("FAIL", f"后台任务 {task_id} 执行失败: {e}")
+            self._update(task_id, status="failed", error=str(e))
+        else:
+            self._update(task_id, status="success", result=result)
+
+    def _update(self, task_id, **fields):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is not None:
+                task.update(fields)
+
+    # ----------------------
+    # 查询任务
+    # ----------------------
+    def get_task(self, task_id):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            return dict(task) if task is not None else None
+
+
+tq = TaskQueue()
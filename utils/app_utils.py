@@ -1,12 +1,112 @@
-from flask import jsonify
+import io
+import os
+import shutil
+import tempfile
+from flask import jsonify, make_response
+from flask.json.provider import DefaultJSONProvider
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时退回 Flask 默认实现
+    orjson = None
+
+# 上传文件拷贝缓冲区大小
+UPLOAD_COPY_BUFSIZE = 1024 * 1024
+
+
+# --- JSON 编解码 ---
+class OrjsonProvider(DefaultJSONProvider):
+    """使用 orjson 编解码请求/响应 JSON，未安装 orjson 时与默认实现一致"""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
 
 # --- 统一返回格式 ---
-def success(message, data=None):
+def success(message, data=None, code=200, etag=None):
     resp = {"status": "success", "message": message}
     if data is not None:
         resp["data"] = data
-    return jsonify(resp), 200
+    response = jsonify(resp)
+    if etag is not None:
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+    return response, code
+
+
+def not_modified(etag):
+    """客户端缓存仍然有效，返回 304"""
+    response = make_response("", 304)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 
 def error(message, code=400):
-    return jsonify({"status": "error", "message": message}), code
\ No newline at end of file
+    return jsonify({"status": "error", "message": message}), code
+
+
+# --- 上传文件保存 ---
+def _real_fileno(stream):
+    """返回上传流底层真实文件的 fd，内存中的流（如 BytesIO、未落盘的 SpooledTemporaryFile）返回 None"""
+    # werkzeug 把小于 500 KiB 的上传放在 SpooledTemporaryFile 中，
+    # 对它调用 fileno() 会先把内容写到磁盘临时文件，反而多一次 I/O，直接走拷贝
+    if isinstance(stream, tempfile.SpooledTemporaryFile) and not getattr(stream, "_rolled", True):
+        return None
+    try:
+        return stream.fileno()
+    except (io.UnsupportedOperation, AttributeError, OSError, ValueError):
+        return None
+
+
+def _copy_upload(stream, dst):
+    """把上传流写入 dst，底层是磁盘临时文件时用 sendfile 在内核中拷贝，否则用大缓冲区拷贝"""
+    src_fd = _real_fileno(stream)
+    if src_fd is not None and hasattr(os, "sendfile"):
+        start = offset = stream.tell()
+        size = os.fstat(src_fd).st_size
+        try:
+            while offset < size:
+                sent = os.sendfile(dst.fileno(), src_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            return
+        except OSError:
+            # 部分平台不支持文件到文件的 sendfile，回退到普通拷贝
+            stream.seek(start)
+            dst.seek(0)
+            dst.truncate()
+    shutil.copyfileobj(stream, dst, length=UPLOAD_COPY_BUFSIZE)
+
+
+def save_upload(file, save_path):
+    """
+    保存上传文件：先写临时文件并 fsync，再原子替换到目标路径，
+    正在读取水印的 ffmpeg 不会读到写了一半的文件；
+    临时文件名唯一，同一目标的并发上传互不覆盖，最后完成的一次生效
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(save_path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as dst:
+            _copy_upload(file.stream, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, save_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
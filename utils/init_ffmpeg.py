@@ -1,3 +1,5 @@
+import functools
+import io
 import os
 import urllib.request
 import zipfile
@@ -8,6 +10,7 @@ from utils.utils import log
 FFMPEG_DIR = os.path.join(os.getcwd(), "ffmpeg")
 FFMPEG_EXE = os.path.join(FFMPEG_DIR, "bin", "ffmpeg.exe")
 FFMPEG_URL = "https://www.gyan.dev/ffmpeg/builds/ffmpeg-release-essentials.zip"  # Windows release 包
+DOWNLOAD_BLOCK_SIZE = 1 << 20
 
 _last_time = 0
 _last_bytes = 0
@@ -57,34 +60,58 @@ def _progress_hook(count, block_size, total_size):
 
 
 
+def _download_zip():
+    """下载 ffmpeg ZIP 到内存，不在磁盘上落一份压缩包"""
+    buf = io.BytesIO()
+    with urllib.request.urlopen(FFMPEG_URL) as response:
+        total_size = int(response.headers.get("Content-Length") or 0)
+        count = 0
+        while chunk := response.read(DOWNLOAD_BLOCK_SIZE):
+            buf.write(chunk)
+            count += 1
+            _progress_hook(count, DOWNLOAD_BLOCK_SIZE, total_size)
+    return buf
+
+
+def _extract_ffmpeg(archive):
+    """
+    把 ZIP 中的顶层目录直接解压为 FFMPEG_DIR，去掉顶层目录名，不再解压到临时目录后移动
+    先解压到 FFMPEG_DIR.part，完成后改名，中途失败不会留下不完整的 ffmpeg 目录
+    """
+    part_dir = FFMPEG_DIR + ".part"
+    shutil.rmtree(part_dir, ignore_errors=True)
+    with zipfile.ZipFile(archive) as zip_ref:
+        for info in zip_ref.infolist():
+            _, sep, rel_path = info.filename.partition("/")
+            if not sep or not rel_path:
+                continue
+            info.filename = rel_path
+            zip_ref.extract(info, part_dir)
+    # ffmpeg.exe 不存在时已有的目录是不完整的，直接替换
+    shutil.rmtree(FFMPEG_DIR, ignore_errors=True)
+    os.replace(part_dir, FFMPEG_DIR)
+
+
+@functools.lru_cache(maxsize=1)
 def init_ffmpeg():
-    """初始化 ffmpeg，如果没有就自动下载并解压"""
+    """初始化 ffmpeg，如果没有就自动下载并解压；只执行一次，之后直接返回路径"""
     if os.path.exists(FFMPEG_EXE):
         log("INFO", f"ffmpeg 已存在: {FFMPEG_EXE}")
         return FFMPEG_EXE
 
     zip_path = "ffmpeg.zip"
 
-    # 如果 ZIP 已存在，则跳过下载
-    if not os.path.exists(zip_path):
+    # 如果 ZIP 已存在（如手动放置），则跳过下载
+    if os.path.exists(zip_path):
+        log("INFO", f"ZIP 文件已存在，跳过下载: {zip_path}")
+        _extract_ffmpeg(zip_path)
+        os.remove(zip_path)
+    else:
         log("INFO", "未找到 ffmpeg ZIP，开始下载...")
-        urllib.request.urlretrieve(FFMPEG_URL, zip_path, _progress_hook)
+        archive = _download_zip()
         print()  # 换行
-        log("SUCCESS", f"下载完成: {zip_path}")
-    else:
-        log("INFO", f"ZIP 文件已存在，跳过下载: {zip_path}")
-
-    # 解压缩
-    with zipfile.ZipFile(zip_path, "r") as zip_ref:
-        zip_ref.extractall("ffmpeg_tmp")
-
-    # 移动到项目 ffmpeg 文件夹
-    extracted_dir = [d for d in os.listdir("ffmpeg_tmp") if os.path.isdir(os.path.join("ffmpeg_tmp", d))][0]
-    shutil.move(os.path.join("ffmpeg_tmp", extracted_dir), FFMPEG_DIR)
-
-    # 清理临时文件
-    os.remove(zip_path)
-    shutil.rmtree("ffmpeg_tmp")
+        log("SUCCESS", "下载完成")
+        _extract_ffmpeg(archive)
 
     log("SUCCESS", f"ffmpeg 已解压到: {FFMPEG_EXE}")
     return FFMPEG_EXE
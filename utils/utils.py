@@ -1,7 +1,11 @@
+import atexit
+import queue
 import sys
 import threading
+import time
 import os
-from datetime import datetime
+import logging
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from typing import Optional
 
 # 全局输出锁，保证线程安全
@@ -19,6 +23,19 @@ COLORS = {
 }
 RESET_COLOR = "\033[0m"
 
+# 各级别控制台输出的 (颜色, 复位) 前后缀，导入时按运行环境算好，不在每条日志中判断
+_CONSOLE_STYLES = {} if _IN_PYCHARM else {level: (color, RESET_COLOR) for level, color in COLORS.items()}
+_NO_STYLE = ("", "")
+
+# 日志文件按大小轮转
+LOG_MAX_BYTES = 8 << 20
+LOG_BACKUP_COUNT = 8
+
+# 日志文件路径 -> Logger，每个文件只打开一次，不再每条日志 open/close
+_file_loggers = {}
+_file_loggers_lock = threading.Lock()
+_file_listeners = []  # [(Logger, QueueHandler, 文件 Handler, QueueListener)]，每个日志文件一个后台写入线程
+
 
 def _safe_console_write(text: str):
     """安全写入控制台，不使用 print()，兼容 PyCharm / Windows"""
@@ -30,11 +47,58 @@ def _safe_console_write(text: str):
             pass
 
 
+def _get_file_logger(log_path: str) -> logging.Logger:
+    """获取写入 log_path 的 Logger，首次使用时创建 RotatingFileHandler"""
+    logger = _file_loggers.get(log_path)
+    if logger is None:
+        with _file_loggers_lock:
+            logger = _file_loggers.get(log_path)
+            if logger is None:
+                handler = RotatingFileHandler(
+                    log_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+                )
+                # 时间戳和级别已由 log() 拼好，这里原样输出
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                # 调用方只把记录放入队列，由后台线程写文件，管理线程/IO 线程不等待磁盘写入
+                log_queue = queue.SimpleQueue()
+                listener = QueueListener(log_queue, handler)
+                listener.start()
+                logger = logging.getLogger(f"ffmpeg_flow.file.{log_path}")
+                logger.setLevel(logging.INFO)
+                logger.propagate = False
+                queue_handler = QueueHandler(log_queue)
+                logger.addHandler(queue_handler)
+                _file_listeners.append((logger, queue_handler, handler, listener))
+                _file_loggers[log_path] = logger
+    return logger
+
+
+def _stop_file_listeners():
+    """
+    退出时写完队列中剩余的日志，之后的日志改为直接写文件
+    atexit 钩子的执行顺序取决于模块导入顺序，其他钩子可能在此之后还要写日志，所以不能只停止后台线程
+    """
+    with _file_loggers_lock:
+        listeners = _file_listeners[:]
+        _file_listeners.clear()
+    for logger, queue_handler, handler, listener in listeners:
+        logger.addHandler(handler)
+        logger.removeHandler(queue_handler)
+        listener.stop()
+
+
+atexit.register(_stop_file_listeners)
+
+
+def _timestamp() -> str:
+    # time.strftime 直接格式化 struct_time，比 datetime.now().strftime 少构造一个对象
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
 def log(level: str, message: str, log_path: Optional[str] = None):
     """统一日志打印，带时间戳，可安全写入文件"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    color = COLORS.get(level, "") if not _IN_PYCHARM else ""
-    reset = RESET_COLOR if color else ""
+    timestamp = _timestamp()
+    color, reset = _CONSOLE_STYLES.get(level, _NO_STYLE)
     formatted_message = f"{timestamp} [{level}] {message}"
     colored_message = f"{color}{formatted_message}{reset}"
 
@@ -44,21 +108,20 @@ def log(level: str, message: str, log_path: Optional[str] = None):
     # 文件写入
     if log_path:
         try:
-            with open(log_path, "a", encoding="utf-8") as f:
-                f.write(formatted_message + "\n")
+            _get_file_logger(log_path).info(formatted_message)
         except Exception as e:
             _safe_console_write(f"{timestamp} [WARN] 日志写入失败: {e}")
 
 
 def log_multiline(level: str, *messages, log_path: Optional[str] = None):
     """多行日志打印，第一行带时间戳，其余行缩进对齐，可安全写入文件"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    timestamp = _timestamp()
     prefix_len = len(timestamp) + 1 + len(f"[{level}] ")
     indent = " " * prefix_len
     log_lines_for_file = []
+    console_lines = []
 
-    color = COLORS.get(level, "") if not _IN_PYCHARM else ""
-    reset = RESET_COLOR if color else ""
+    color, reset = _CONSOLE_STYLES.get(level, _NO_STYLE)
 
     for i, msg in enumerate(messages):
         lines = str(msg).split("\n")
@@ -69,12 +132,14 @@ def log_multiline(level: str, *messages, log_path: Optional[str] = None):
                 formatted_line = f"{indent}{line}"
             log_lines_for_file.append(formatted_line)
             # 控制台输出带颜色
-            _safe_console_write(f"{color}{formatted_line}{reset}")
+            console_lines.append(f"{color}{formatted_line}{reset}")
+
+    # 整段一次写入控制台，只加一次锁、flush 一次，也不会和其他线程的输出交错
+    _safe_console_write("\n".join(console_lines))
 
     # 文件写入
     if log_path:
         try:
-            with open(log_path, "a", encoding="utf-8") as f:
-                f.write("\n".join(log_lines_for_file) + "\n")
+            _get_file_logger(log_path).info("\n".join(log_lines_for_file))
         except Exception as e:
             _safe_console_write(f"{timestamp} [WARN] 多行日志写入失败: {e}")
@@ -0,0 +1,2 @@
+# WSGI 入口：gunicorn -c gunicorn.conf.py wsgi:app
+from app import app